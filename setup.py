@@ -22,7 +22,7 @@ setup(
     long_description=long_description,
     packages=find_packages(),
     install_requires=['transformers', 'torch', 'torchaudio', 'speechbrain',
-                      'librosa', 'noisereduce', 'numpy', 'scipy', 'unidecode', 'inflect', 'librosa', 'python-dotenv', 'deep-phonemizer', 'argparse', 'pydub', 'pyctcdecode'],
+                      'librosa', 'noisereduce', 'numpy', 'scipy', 'unidecode', 'inflect', 'librosa', 'python-dotenv', 'deep-phonemizer', 'argparse', 'pydub', 'pyctcdecode', 'soundfile', 'soxr'],
     keywords=['python', 'speech', 'voice', 'nlp'],
     classifiers=[
         "Development Status :: 1 - Planning",
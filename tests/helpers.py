@@ -0,0 +1,18 @@
+"""
+Audio fixtures shared by the tests.
+
+"""
+import numpy as np
+import soundfile as sf
+import io
+
+
+def sine(sample_rate, seconds=1.0, frequency=440.0):
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    return (0.5 * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+def to_wav_bytes(speech, sample_rate=16000):
+    buffer = io.BytesIO()
+    sf.write(buffer, speech, sample_rate, format='WAV', subtype='FLOAT')
+    return buffer.getvalue()
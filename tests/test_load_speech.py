@@ -0,0 +1,105 @@
+"""
+Tests for reading audio into arrays for transcription.
+
+"""
+from tmh.transcribe import load_speech_bytes, stream_speech, MIN_CHUNK_LENGTH
+from helpers import sine, to_wav_bytes
+import numpy as np
+import soundfile as sf
+import tempfile
+import unittest
+import os
+
+
+class TestLoadSpeechBytes(unittest.TestCase):
+
+    def test_mono_16k(self):
+        """
+        16 kHz mono audio is returned as is.
+        """
+        speech = sine(16000)
+        loaded = load_speech_bytes(to_wav_bytes(speech, 16000))
+        self.assertEqual(loaded.dtype, np.float32)
+        self.assertEqual(loaded.ndim, 1)
+        np.testing.assert_allclose(loaded, speech, atol=1e-6)
+
+    def test_stereo(self):
+        """
+        Stereo audio is downmixed by averaging the channels.
+        """
+        left = sine(16000)
+        right = sine(16000, frequency=220.0)
+        loaded = load_speech_bytes(
+            to_wav_bytes(np.stack([left, right], axis=1), 16000))
+        self.assertEqual(loaded.dtype, np.float32)
+        self.assertEqual(loaded.shape, left.shape)
+        np.testing.assert_allclose(loaded, (left + right) / 2, atol=1e-6)
+
+    def test_resample_44k(self):
+        """
+        44.1 kHz audio is resampled to 16 kHz.
+        """
+        speech = sine(44100)
+        loaded = load_speech_bytes(to_wav_bytes(speech, 44100))
+        self.assertEqual(loaded.dtype, np.float32)
+        self.assertEqual(loaded.ndim, 1)
+        self.assertEqual(len(loaded), 16000)
+        # The tone survives the resampling with its amplitude intact
+        self.assertAlmostEqual(float(np.abs(loaded[1000:-1000]).max()), 0.5, places=2)
+
+    def test_stereo_44k(self):
+        """
+        44.1 kHz stereo audio is downmixed and resampled.
+        """
+        speech = sine(44100)
+        loaded = load_speech_bytes(
+            to_wav_bytes(np.stack([speech, speech], axis=1), 44100))
+        self.assertEqual(loaded.ndim, 1)
+        self.assertEqual(len(loaded), 16000)
+
+
+class TestStreamSpeech(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.audio_path = os.path.join(self.tmpdir.name, "speech.wav")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def stream(self, speech, sample_rate):
+        sf.write(self.audio_path, speech, sample_rate, subtype='FLOAT')
+        return list(stream_speech(self.audio_path, block_seconds=1))
+
+    def test_44k(self):
+        """
+        44.1 kHz audio is streamed at 16 kHz without a separate chunk for
+        the flush of the resampler.
+        """
+        speech = sine(44100, seconds=2.5)
+        chunks = self.stream(speech, 44100)
+        self.assertEqual(len(chunks), 3)
+        for chunk in chunks:
+            self.assertEqual(chunk.dtype, np.float32)
+            self.assertGreaterEqual(len(chunk), MIN_CHUNK_LENGTH)
+        self.assertLessEqual(abs(sum(map(len, chunks)) - 40000), 1)
+
+    def test_44k_short_last_block(self):
+        """
+        A last block too short for the model is appended to the one before.
+        """
+        speech = sine(44100, seconds=2.0 + 100 / 44100)
+        chunks = self.stream(speech, 44100)
+        self.assertEqual(len(chunks), 2)
+        for chunk in chunks:
+            self.assertGreaterEqual(len(chunk), MIN_CHUNK_LENGTH)
+        self.assertLessEqual(abs(sum(map(len, chunks)) - 32036), 1)
+
+    def test_16k(self):
+        """
+        16 kHz audio is streamed as is.
+        """
+        speech = sine(16000, seconds=2.5)
+        chunks = self.stream(speech, 16000)
+        self.assertEqual([len(chunk) for chunk in chunks], [16000, 16000, 8000])
+        np.testing.assert_allclose(np.concatenate(chunks), speech, atol=1e-6)
@@ -0,0 +1,47 @@
+"""
+Tests for skipping silent chunks during transcription.
+
+"""
+from tmh.transcribe import is_silent, SILENCE_THRESHOLD
+from helpers import sine
+import numpy as np
+import unittest
+
+
+class TestIsSilent(unittest.TestCase):
+
+    def setUp(self):
+        self.speech = sine(16000)
+        self.silence = np.zeros(16000, dtype=np.float32)
+
+    def test_silence(self):
+        """
+        All zero and very quiet chunks are silent.
+        """
+        self.assertTrue(is_silent(self.silence))
+        self.assertTrue(is_silent(self.speech * SILENCE_THRESHOLD))
+
+    def test_speech(self):
+        """
+        A chunk well above the threshold is not silent.
+        """
+        self.assertFalse(is_silent(self.speech))
+
+    def test_threshold(self):
+        """
+        The threshold compares against the RMS energy of the chunk.
+        """
+        # The RMS of a sine with amplitude 0.5 is 0.5 / sqrt(2)
+        self.assertTrue(is_silent(self.speech, threshold=0.36))
+        self.assertFalse(is_silent(self.speech, threshold=0.35))
+
+    def test_disabled(self):
+        """
+        A threshold of 0 or None treats every chunk as speech.
+        """
+        self.assertFalse(is_silent(self.silence, threshold=0))
+        self.assertFalse(is_silent(self.silence, threshold=None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Tests for the per-token duration statistics of get_speech_rate_variability.
+
+"""
+from tmh.transcribe import get_speech_rate_variability
+import numpy as np
+import unittest
+
+
+def reference_speech_rate_variability(time_stamps, type='char', downsample=320, sample_rate=16000):
+    """
+    The original per-token loop, kept as a reference for the vectorized version.
+    """
+    base = downsample / sample_rate
+    token_durations = {}
+
+    for time_stamp in time_stamps[0]:
+        start_time = round(time_stamp['start_offset']*base, 2)
+        end_time = round(time_stamp['end_offset']*base, 2)
+        char = time_stamp[type]
+        duration = end_time - start_time
+
+        if char not in token_durations:
+            token_durations[char] = []
+
+        token_durations[char].append(duration)
+
+    averages = dict()
+    stds = dict()
+    variances = dict()
+
+    for token, durations in token_durations.items():
+        n = len(durations)
+        mean = sum(durations) / n
+        averages[token] = np.sum(durations) / n
+        stds[token] = np.std(durations)
+        variances[token] = sum([(x - mean) ** 2 for x in durations]) / n
+
+    return averages, stds, variances
+
+
+def time_stamps(tokens, type='char', seed=0):
+    rng = np.random.default_rng(seed)
+    offsets = np.cumsum(rng.integers(1, 20, size=len(tokens) + 1))
+    return [[{type: token,
+              'start_offset': int(start),
+              'end_offset': int(end)}
+             for token, start, end in zip(tokens, offsets[:-1], offsets[1:])]]
+
+
+class TestSpeechRateVariability(unittest.TestCase):
+
+    def assert_matches_reference(self, stamps, **kwargs):
+        results = get_speech_rate_variability(stamps, **kwargs)
+        expected = reference_speech_rate_variability(stamps, **kwargs)
+        for result, reference in zip(results, expected):
+            # Same tokens, in order of first appearance
+            self.assertEqual(list(result), list(reference))
+            for token in reference:
+                self.assertAlmostEqual(result[token], reference[token], places=9)
+
+    def test_chars(self):
+        """
+        Repeated characters are grouped in order of first appearance.
+        """
+        self.assert_matches_reference(time_stamps(list("hej och välkommen hit")))
+
+    def test_words(self):
+        """
+        Words are grouped when timestamps are per word.
+        """
+        words = "det var en gång en katt som hette katt".split()
+        self.assert_matches_reference(time_stamps(words, type='word'), type='word')
+
+    def test_long(self):
+        """
+        Many timestamps over a small alphabet.
+        """
+        rng = np.random.default_rng(1)
+        tokens = list(rng.choice(list("abcdefgh "), size=2000))
+        self.assert_matches_reference(time_stamps(tokens, seed=1))
+
+    def test_single(self):
+        """
+        A token seen once has no variance.
+        """
+        averages, stds, variances = get_speech_rate_variability(time_stamps(["a"]))
+        self.assertEqual(list(averages), ["a"])
+        self.assertEqual(stds["a"], 0.0)
+        self.assertEqual(variances["a"], 0.0)
+
+    def test_empty(self):
+        """
+        No timestamps give empty statistics.
+        """
+        self.assertEqual(get_speech_rate_variability([[]]), ({}, {}, {}))
+        self.assertEqual(reference_speech_rate_variability([[]]), ({}, {}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""
+Tests for transcribing several utterances together, with a tiny randomly
+initialized model.
+
+"""
+from tmh.transcribe import TranscribeModel, TranscriptionError, transcribe_speech_batch
+from helpers import to_wav_bytes
+from transformers import (Wav2Vec2Config, Wav2Vec2CTCTokenizer, Wav2Vec2FeatureExtractor,
+                          Wav2Vec2ForCTC, Wav2Vec2Processor)
+import concurrent.futures
+import numpy as np
+import tempfile
+import unittest
+import asyncio
+import torch
+import json
+import os
+
+
+VOCAB = ["<pad>", "<unk>", "|"] + list("abcdefghijklmnopqrstuvwxyzåäö")
+
+
+def tiny_model(use_attention_mask=True):
+    """
+    A randomly initialized wav2vec2 model and its processor. With an
+    attention mask the model uses layer norm, like the large checkpoints,
+    and without one group norm, like the base checkpoints.
+    """
+    torch.manual_seed(0)
+    config = Wav2Vec2Config(
+        vocab_size=len(VOCAB),
+        hidden_size=16,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=32,
+        conv_dim=(8,) * 7,
+        num_conv_pos_embeddings=16,
+        num_conv_pos_embedding_groups=2,
+        feat_extract_norm="layer" if use_attention_mask else "group",
+        do_stable_layer_norm=use_attention_mask,
+        pad_token_id=0)
+    model = Wav2Vec2ForCTC(config).eval()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        vocab_file = os.path.join(tmpdir, "vocab.json")
+        with open(vocab_file, "w") as f:
+            json.dump({token: i for i, token in enumerate(VOCAB)}, f)
+        tokenizer = Wav2Vec2CTCTokenizer(
+            vocab_file, unk_token="<unk>", pad_token="<pad>", word_delimiter_token="|")
+    feature_extractor = Wav2Vec2FeatureExtractor(
+        feature_size=1, sampling_rate=16000, padding_value=0.0, do_normalize=True,
+        return_attention_mask=use_attention_mask)
+    return model, Wav2Vec2Processor(feature_extractor=feature_extractor, tokenizer=tokenizer)
+
+
+def transcribe_alone(speech, model, processor, chunk_length=30 * 16000):
+    """
+    Transcribes the 30 second chunks of an utterance one at a time.
+    """
+    chunk_ids = []
+    for start in range(0, len(speech), chunk_length):
+        input_values = processor(speech[start:start + chunk_length], sampling_rate=16000,
+                                 return_tensors="pt").input_values
+        with torch.inference_mode():
+            chunk_ids.append(model(input_values).logits.argmax(dim=-1)[0])
+    return processor.decode(torch.cat(chunk_ids)).lower()
+
+
+def noise(seconds, seed):
+    rng = np.random.default_rng(seed)
+    return (0.1 * rng.standard_normal(int(16000 * seconds))).astype(np.float32)
+
+
+class TestTranscribeSpeechBatch(unittest.TestCase):
+
+    def setUp(self):
+        # Mixed lengths, with one utterance split into 30 second chunks
+        self.speeches = [noise(seconds, seed)
+                         for seed, seconds in enumerate([1.0, 35.0, 0.5, 3.0, 1.0])]
+
+    def assert_matches_alone(self, model, processor):
+        transcripts = transcribe_speech_batch(
+            self.speeches, model=model, processor=processor, max_batch=3)
+        self.assertEqual(len(transcripts), len(self.speeches))
+        for speech, transcript in zip(self.speeches, transcripts):
+            self.assertEqual(transcript, transcribe_alone(speech, model, processor))
+
+    def test_attention_mask(self):
+        """
+        Padded batches give the same ids as each chunk on its own.
+        """
+        self.assert_matches_alone(*tiny_model(use_attention_mask=True))
+
+    def test_no_attention_mask(self):
+        """
+        Models without an attention mask give the same ids as each chunk on
+        its own.
+        """
+        self.assert_matches_alone(*tiny_model(use_attention_mask=False))
+
+    def test_empty(self):
+        """
+        An empty utterance gives an empty transcription.
+        """
+        model, processor = tiny_model()
+        transcripts = transcribe_speech_batch(
+            [np.zeros(0, dtype=np.float32), self.speeches[0]], model=model, processor=processor)
+        self.assertEqual(transcripts[0], "")
+        self.assertEqual(transcripts[1], transcribe_alone(self.speeches[0], model, processor))
+
+
+class TestTranscribeRequests(unittest.TestCase):
+
+    def setUp(self):
+        # Set up the batching parts of a TranscribeModel around the tiny
+        # model, without downloading a checkpoint
+        self.model = TranscribeModel.__new__(TranscribeModel)
+        self.model.use_vad = False
+        self.model.use_lm = False
+        self.model.model, self.model.processor = tiny_model()
+        self.model.dtype = torch.float32
+        self.model.max_batch = 8
+        self.model.max_wait_ms = 20
+        self.model.batch_queue = None
+        self.model.batch_task = None
+        self.model.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.speeches = [noise(1.0, 0), noise(2.0, 1)]
+
+    def tearDown(self):
+        self.model.pool.shutdown()
+
+    def expected(self, speech):
+        return transcribe_alone(speech, self.model.model, self.model.processor)
+
+    def test_unreadable_request(self):
+        """
+        A request that cannot be read only fails its own result.
+        """
+        requests = [(None, to_wav_bytes(self.speeches[0]), None),
+                    (None, b"not audio", None),
+                    (None, to_wav_bytes(self.speeches[1]), None)]
+        results = self.model.transcribe_requests(requests)
+        self.assertEqual(results[0], self.expected(self.speeches[0]))
+        self.assertIsInstance(results[1], TranscriptionError)
+        self.assertEqual(results[2], self.expected(self.speeches[1]))
+
+    def test_transcribe_async(self):
+        """
+        Concurrent requests are batched, and an unreadable one only fails
+        its own future.
+        """
+        async def transcribe_all():
+            return await asyncio.gather(
+                self.model.transcribe_async(bytes=to_wav_bytes(self.speeches[0])),
+                self.model.transcribe_async(bytes=b"not audio"),
+                self.model.transcribe_async(bytes=to_wav_bytes(self.speeches[1])),
+                return_exceptions=True)
+
+        results = asyncio.run(transcribe_all())
+        self.assertEqual(results[0], self.expected(self.speeches[0]))
+        self.assertIsInstance(results[1], TranscriptionError)
+        self.assertEqual(results[2], self.expected(self.speeches[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Tests for checking and converting audio files before transcription.
+
+"""
+from tmh.utils import ensure_wav, is_pcm_mono, ConversionError
+from helpers import sine
+import soundfile as sf
+import tempfile
+import unittest
+import os
+
+
+class TestEnsureWav(unittest.TestCase):
+
+    def setUp(self):
+        # convert_to_wav writes into the working directory
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def wav_files(self):
+        return [f for f in os.listdir(".") if f.endswith(".wav")]
+
+    def test_pcm_mono_flac(self):
+        """
+        A 16 kHz mono PCM flac is returned as is, without writing a wav.
+        """
+        sf.write("speech.flac", sine(16000), 16000, subtype='PCM_16')
+        self.assertTrue(is_pcm_mono("speech.flac"))
+        self.assertEqual(ensure_wav("speech.flac"), ("speech.flac", False))
+        self.assertEqual(self.wav_files(), [])
+
+    def test_other_sample_rate(self):
+        """
+        A PCM flac in another sample rate is converted.
+        """
+        sf.write("speech.flac", sine(8000), 8000, subtype='PCM_16')
+        self.assertFalse(is_pcm_mono("speech.flac"))
+        audio_path, converted = ensure_wav("speech.flac")
+        self.assertTrue(converted)
+        self.assertEqual(audio_path, "speech.wav")
+        self.assertTrue(os.path.exists(audio_path))
+
+    def test_not_pcm(self):
+        """
+        A compressed, non PCM file is converted.
+        """
+        sf.write("speech.ogg", sine(16000), 16000, format='OGG', subtype='VORBIS')
+        self.assertFalse(is_pcm_mono("speech.ogg"))
+        audio_path, converted = ensure_wav("speech.ogg")
+        self.assertTrue(converted)
+        self.assertEqual(audio_path, "speech.wav")
+        self.assertTrue(os.path.exists(audio_path))
+
+    def test_unreadable_header(self):
+        """
+        A file whose header cannot be read still goes through conversion.
+        """
+        with open("speech.flac", "wb") as f:
+            f.write(b"not audio")
+        self.assertFalse(is_pcm_mono("speech.flac"))
+        with self.assertRaises(ConversionError):
+            ensure_wav("speech.flac")
+
+
+if __name__ == '__main__':
+    unittest.main()
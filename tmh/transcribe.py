@@ -1,12 +1,37 @@
 import asyncio
+import concurrent.futures
+import contextlib
+import functools
 import io
 import logging
 import multiprocessing
+import operator
+import os
+import threading
+
+
+def _supports_expandable_segments():
+    """
+    Checks, without importing torch, whether the installed torch is 2.1 or
+    newer. Older versions reject `expandable_segments` as an unknown option.
+    """
+    try:
+        from importlib.metadata import version
+        major, minor = (int(part) for part in version("torch").split(".")[:2])
+    except Exception:
+        return False
+    return (major, minor) >= (2, 1)
+
+
+# Let the caching allocator grow its segments instead of fragmenting on the
+# varying chunk sizes. Must be set before CUDA is initialized.
+if _supports_expandable_segments():
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 import torchaudio
 import torch
 from transformers import Wav2Vec2Processor, Wav2Vec2ForCTC, Wav2Vec2ProcessorWithLM
 from transformers import HubertForSequenceClassification, Wav2Vec2FeatureExtractor
-import librosa
 from tmh.utils import ensure_wav
 from tmh.language_files import get_model
 from tmh.transcribe_with_vad import transcribe_bytes_split_on_speech, transcribe_from_audio_path_split_on_speech
@@ -14,7 +39,7 @@ from tmh.transcribe_with_lm import transcribe_bytes_with_lm, transcribe_bytes_wi
 
 from speechbrain.pretrained import EncoderClassifier
 import soundfile as sf
-import os
+import soxr
 import numpy as np
 
 logger = logging.getLogger()
@@ -30,18 +55,98 @@ class TranscriptionError(Exception):
 
 # TODO
 # check language
-# enable batch mode
 
-PROCESSES = multiprocessing.cpu_count() - 1
+PROCESSES = max(1, multiprocessing.cpu_count() - 1)
+# Resolved once, rather than querying the driver on every call
+_DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# Maximum number of queued requests coalesced into a single forward pass
+MAX_BATCH = 8
+# Time to wait for more requests before running a partial batch
+MAX_WAIT_MS = 20
+# RMS energy below which a streamed chunk is considered silent
+SILENCE_THRESHOLD = 1e-3
+# Lengths in seconds that streamed chunks are padded up to when the forward
+# pass is compiled or captured in a CUDA graph
+CHUNK_SECONDS = (2, 5, 10, 20, 30)
+# Shortest chunk in samples that the wav2vec2 feature encoder accepts
+MIN_CHUNK_LENGTH = 400
+
+def _locked(loader):
+    """
+    Serializes calls to a cached loader so that concurrent callers never
+    build the same model twice. Each loader has its own lock, so a long
+    load does not hold up calls to the other loaders.
+    """
+    lock = threading.Lock()
+
+    @functools.wraps(loader)
+    def wrapper(*args):
+        with lock:
+            return loader(*args)
+    wrapper.cache_clear = loader.cache_clear
+    return wrapper
+
+
+@_locked
+@functools.lru_cache(maxsize=4)
+def _get_w2v2(model_id, device):
+    processor = Wav2Vec2Processor.from_pretrained(model_id)
+    model = Wav2Vec2ForCTC.from_pretrained(model_id).to(device)
+    return model.eval(), processor
+
+
+@_locked
+@functools.lru_cache(maxsize=1)
+def _get_hubert_er():
+    model = HubertForSequenceClassification.from_pretrained(
+        "superb/hubert-large-superb-er")
+    feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(
+        "superb/hubert-large-superb-er")
+    return model.eval(), feature_extractor
+
+
+@_locked
+@functools.lru_cache(maxsize=1)
+def _get_lang_classifier():
+    return EncoderClassifier.from_hparams(
+        source="speechbrain/lang-id-commonlanguage_ecapa", savedir="pretrained_models/lang-id-commonlanguage_ecapa",
+        run_opts={"device": str(_DEVICE)})
+
+
+@_locked
+@functools.lru_cache(maxsize=1)
+def _get_speaker_classifier():
+    return EncoderClassifier.from_hparams(
+        source="speechbrain/spkrec-xvect-voxceleb", savedir="pretrained_models/spkrec-xvect-voxceleb",
+        run_opts={"device": str(_DEVICE)})
+
+
+def _autocast(device, dtype, cache_enabled=True):
+    """
+    Autocast context for running a forward pass in `dtype`. A `dtype` of
+    None or float32 leaves the model in full precision.
+    """
+    if dtype is None or dtype == torch.float32:
+        return contextlib.nullcontext()
+    # Older versions of torch do not accept `cache_enabled`
+    if not cache_enabled:
+        return torch.autocast(device_type=device.type, dtype=dtype, cache_enabled=False)
+    return torch.autocast(device_type=device.type, dtype=dtype)
 
 
 class TranscribeModel:
-    def __init__(self, use_vad=False, use_lm=False, language='Swedish', model_id=None):
+    def __init__(self, use_vad=False, use_lm=False, language='Swedish', model_id=None, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS, fp16=True, quantize=True, cuda_graph=True):
         """
         use_vad: use voice activity detection
         use_lm: use language model
         language: language to use
         model_id: the name of a HuggingFace model, overrides `language`
+        max_batch: maximum number of queued requests transcribed in one batch
+        max_wait_ms: how long a queued request waits for others to batch with
+        fp16: run the model in half precision when on a GPU
+        quantize: run the linear layers in int8 when on a CPU
+        cuda_graph: replay the forward pass over streamed chunks from
+            captured CUDA graphs when on a GPU
 
         return: a TranscribeModel object
         """
@@ -49,22 +154,27 @@ class TranscribeModel:
         self.use_vad = use_vad
         self.use_lm = use_lm
         self.model_id = model_id if model_id else self.get_model_id()
-        # self.task_queue = multiprocessing.Queue() # TODO
-        self.processes = []
-        self.device = torch.device(
-            'cuda' if torch.cuda.is_available() else 'cpu')
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.batch_queue = None
+        self.batch_task = None
+        self.device = _DEVICE
+        # Threads share the one model. On CUDA the forward passes release the
+        # GIL and are serialized on the device, while loading and decoding
+        # audio run in parallel. On CPU every forward pass already runs on
+        # all cores through torch's intra-op threads, so the pool runs one
+        # transcription at a time rather than multiplying the threads.
+        workers = PROCESSES if self.device.type == 'cuda' else 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.dtype = torch.float16 if fp16 and self.device.type == 'cuda' else torch.float32
+        self.quantize = quantize
+        self.compiled = False
+        # Capturing under autocast needs `cache_enabled`, which torch 1.10
+        # does not have, so CUDA graphs are only used from torch 2.0
+        self.cuda_graph = cuda_graph and self.device.type == 'cuda' \
+            and hasattr(torch, "compile") and not (self.use_vad or self.use_lm)
+        self.chunk_forward = None
         self.model, self.processor = self.initialize()
-        # self.run() # TODO
-
-    def run(self):
-        while True:
-            while len(self.processes) < PROCESSES:
-                self.processes.append(
-                    multiprocessing.Process(target=self.worker, kwargs={}))
-                self.processes[-1].start()
-
-    def worker(self, **kwargs):
-        self.transcribe(**kwargs)
 
     def initialize(self):
         if self.use_vad and self.use_lm:
@@ -88,6 +198,25 @@ class TranscribeModel:
             self.processor = Wav2Vec2Processor.from_pretrained(self.model_id)
             self.model = Wav2Vec2ForCTC.from_pretrained(
                 self.model_id).to(self.device)
+        self.model.eval()
+        if self.device.type == 'cpu' and self.quantize:
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            logger.info("Quantized model to int8")
+        # Only the chunks streamed by `transcribe` have a few fixed lengths,
+        # so only that forward pass is compiled. `self.model` is left as is
+        # for the paths that feed arbitrary lengths. torch.compile needs
+        # torch 2.0.
+        self.compiled = self.device.type == 'cuda' and not (self.use_vad or self.use_lm) \
+            and hasattr(torch, "compile") and not os.environ.get("TMH_DISABLE_COMPILE")
+        # The CUDA graphs are captured here, before the pool is given any work
+        if self.compiled or self.cuda_graph:
+            self.chunk_forward = FixedShapeForward(
+                self.model,
+                dtype=self.dtype,
+                use_attention_mask=self.processor.feature_extractor.return_attention_mask,
+                compile=self.compiled,
+                cuda_graph=self.cuda_graph)
         logger.info(
             "Model was initialized with model_id: {}".format(self.model_id))
         return self.model, self.processor
@@ -153,13 +282,124 @@ class TranscribeModel:
                     processor=self.processor,
                     reduce_noise=reduce_noise,
                     classify_emotion=classify_emotion,
-                    output_word_offsets=output_word_offsets)
+                    output_word_offsets=output_word_offsets,
+                    dtype=self.dtype,
+                    chunk_forward=self.chunk_forward)
+        except Exception as e:
+            logger.error(e)
+            raise TranscriptionError(e)
+
+    def queue_transcription(self, audio_path, *args, **kwargs):
+        """
+        Transcribes an audio file in a background thread. Takes the same
+        arguments as `transcribe`.
+
+        return: a concurrent.futures.Future holding the transcription
+        """
+        return self.pool.submit(self.transcribe, audio_path, *args, **kwargs)
+
+    def transcribe_batch(self, audio_paths):
+        """
+        Transcribes several audio files together, running up to `max_batch`
+        chunks of at most 30 seconds through the model at once.
+
+        audio_paths: list of paths to audio files
+
+        return: list of transcriptions, in the same order as `audio_paths`
+        """
+        if self.use_vad or self.use_lm:
+            return [self.transcribe(audio_path) for audio_path in audio_paths]
+        try:
+            speeches = [load_speech(audio_path) for audio_path in audio_paths]
+            return transcribe_speech_batch(
+                speeches, model=self.model, processor=self.processor,
+                dtype=self.dtype, max_batch=self.max_batch)
         except Exception as e:
             logger.error(e)
             raise TranscriptionError(e)
 
-    def queue_transcription(self, audio_path, *args):
-        self.task_queue.put((audio_path, *args))
+    async def transcribe_async(self, audio_path=None, bytes=None):
+        """
+        Queues an audio file or a chunk of speech for transcription. Requests
+        arriving within `max_wait_ms` of each other are transcribed together
+        in batches of up to `max_batch`.
+
+        audio_path: path to audio file
+        bytes: a chunk of speech, used if `audio_path` is not given
+
+        return: the transcription
+        """
+        if audio_path is None and bytes is None:
+            raise ValueError("Either audio_path or bytes must be given")
+        loop = asyncio.get_running_loop()
+        if self.batch_task is None or self.batch_task.done():
+            self.batch_queue = asyncio.Queue()
+            self.batch_task = loop.create_task(self.process_batches())
+        future = loop.create_future()
+        await self.batch_queue.put((audio_path, bytes, future))
+        return await future
+
+    async def process_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.batch_queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(requests) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(await asyncio.wait_for(self.batch_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await loop.run_in_executor(
+                    self.pool, self.transcribe_requests, requests)
+            except Exception as e:
+                # Only a failing forward pass fails the whole batch
+                logger.error(e)
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(TranscriptionError(e))
+                continue
+            for (_, _, future), result in zip(requests, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def transcribe_requests(self, requests):
+        """
+        Transcribes a batch of queued (audio_path, bytes, future) requests.
+
+        return: for each request either its transcription, or the error
+            raised while reading its audio
+        """
+        results = [None] * len(requests)
+        speeches = []
+        indices = []
+        for i, (audio_path, bytes, _) in enumerate(requests):
+            try:
+                if self.use_vad or self.use_lm:
+                    results[i] = self.transcribe(audio_path) if audio_path \
+                        else self.transcribe_bytes(bytes)
+                    continue
+                speeches.append(load_speech(audio_path) if audio_path
+                                else load_speech_bytes(bytes))
+                indices.append(i)
+            except Exception as e:
+                logger.error(e)
+                results[i] = e if isinstance(e, TranscriptionError) else TranscriptionError(e)
+
+        if speeches:
+            transcripts = transcribe_speech_batch(
+                speeches, model=self.model, processor=self.processor,
+                dtype=self.dtype, max_batch=self.max_batch)
+            for i, transcript in zip(indices, transcripts):
+                results[i] = transcript
+        return results
 
     def transcribe_bytes(self, bytes, output_format: str = "json"):
         """
@@ -190,54 +430,35 @@ class TranscribeModel:
             return transcribe_bytes(
                 bytes=bytes,
                 model=self.model,
-                processor=self.processor)
-
-    def process_tasks(self):
-        logger = multiprocessing.get_logger()
-        proc = os.getpid()
-        while not self.task_queue.empty():
-            try:
-                (audio, *args) = self.task_queue.get()
-                self.transcribe(audio, *args)
-            except Exception as e:
-                logger.error(e)
-            logger.info(f"Process {proc} completed successfully")
-        return True
+                processor=self.processor,
+                dtype=self.dtype)
 
 
 def extract_speaker_embedding(audio_path):
-    classifier = EncoderClassifier.from_hparams(
-        source="speechbrain/spkrec-xvect-voxceleb", savedir="pretrained_models/spkrec-xvect-voxceleb")
+    classifier = _get_speaker_classifier()
     signal, fs = torchaudio.load(audio_path)
-    embeddings = classifier.encode_batch(signal)
-    # print(embeddings)
-    return embeddings
+    with torch.inference_mode():
+        embeddings = classifier.encode_batch(signal.to(classifier.device))
+    return embeddings.cpu()
 
 
 def classify_emotion(audio_path):
-    audio_path, converted = ensure_wav(audio_path)
-
-    model = HubertForSequenceClassification.from_pretrained(
-        "superb/hubert-large-superb-er")
-    feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(
-        "superb/hubert-large-superb-er")
-    speech, _ = librosa.load(audio_path, sr=16000, mono=True)
+    model, feature_extractor = _get_hubert_er()
+    speech = load_speech(audio_path, sample_rate=16000)
 
     inputs = feature_extractor(
         speech, sampling_rate=16000, padding=True, return_tensors="pt")
 
-    logits = model(**inputs).logits
-    predicted_ids = torch.argmax(logits, dim=-1)
+    with torch.inference_mode():
+        logits = model(**inputs).logits
+        predicted_ids = torch.argmax(logits, dim=-1)
     labels = [model.config.id2label[_id] for _id in predicted_ids.tolist()]
     # print(labels)
-    if converted:
-        os.remove(audio_path)
     return(labels)
 
 
 def classify_language(audio_path):
-    classifier = EncoderClassifier.from_hparams(
-        source="speechbrain/lang-id-commonlanguage_ecapa", savedir="pretrained_models/lang-id-commonlanguage_ecapa")
+    classifier = _get_lang_classifier()
     out_prob, score, index, text_lab = classifier.classify_file(audio_path)
     return(text_lab[0])
 
@@ -254,51 +475,264 @@ def get_speech_rate_time_stamps(time_stamps, downsample=320, sample_rate=16000):
     return speech_rate
 
 
-def calculate_variance(data):
-    n = len(data)
-    mean = sum(data) / n
-    # Square deviations
-    deviations = [(x - mean) ** 2 for x in data]
-    # Variance
-    variance = sum(deviations) / n
-    return variance
-
-
 def get_speech_rate_variability(time_stamps, type='char', downsample=320, sample_rate=16000):
     base = downsample / sample_rate
-    token_durations = {}
-
-    for time_stamp in time_stamps[0]:
+    if not time_stamps[0]:
+        return {}, {}, {}
+
+    # Split the list of timestamp dicts into one array per field in a single pass
+    chars, start_offsets, end_offsets = zip(
+        *map(operator.itemgetter(type, 'start_offset', 'end_offset'), time_stamps[0]))
+    chars = np.array(chars)
+    start_times = np.round(np.array(start_offsets, dtype=np.int64) * base, 2)
+    end_times = np.round(np.array(end_offsets, dtype=np.int64) * base, 2)
+    durations = end_times - start_times
+
+    # Group the durations by token, keeping the tokens in order of appearance
+    tokens, first_index, inverse = np.unique(
+        chars, return_index=True, return_inverse=True)
+    counts = np.bincount(inverse)
+    means = np.bincount(inverse, weights=durations) / counts
+    variances = np.bincount(
+        inverse, weights=(durations - means[inverse]) ** 2) / counts
+    stds = np.sqrt(variances)
+
+    order = np.argsort(first_index)
+    tokens = tokens[order].tolist()
+    averages = dict(zip(tokens, means[order].tolist()))
+    stds = dict(zip(tokens, stds[order].tolist()))
+    variances = dict(zip(tokens, variances[order].tolist()))
 
-        start_time = round(time_stamp['start_offset']*base, 2)
-        end_time = round(time_stamp['end_offset']*base, 2)
-        char = time_stamp[type]
-        duration = end_time - start_time
+    return averages, stds, variances
 
-        if char not in token_durations:
-            token_durations[char] = []
 
-        token_durations[char].append(duration)
+def is_silent(speech, threshold=SILENCE_THRESHOLD):
+    """
+    Checks whether the RMS energy of a chunk of speech is below `threshold`.
+    A `threshold` of None or 0 treats every chunk as speech.
+    """
+    if not threshold:
+        return False
+    return float(np.sqrt(np.mean(np.square(speech, dtype=np.float32)))) < threshold
+
+
+def stream_speech(audio_path, sample_rate=16000, block_seconds=30, min_length=MIN_CHUNK_LENGTH):
+    """
+    Reads a wav file in blocks of `block_seconds`, yielding mono float32
+    arrays sampled at `sample_rate`. A last block shorter than `min_length`
+    samples is appended to the block before it.
+    """
+    with sf.SoundFile(audio_path) as f:
+        # Ensure that the sample rate is 16k. Resampling is done as one
+        # stream so that there are no artifacts at the block edges.
+        resampler = None
+        if f.samplerate != sample_rate:
+            resampler = soxr.ResampleStream(f.samplerate, sample_rate, 1, dtype='float32')
+        # Each block is held back until the next one is read, so that a
+        # short last block and the flush of the resampler can be appended
+        # to it rather than yielded on their own
+        previous = None
+        for speech in f.blocks(blocksize=block_seconds * f.samplerate, dtype='float32'):
+            if speech.ndim > 1:
+                speech = speech.mean(axis=1, dtype=np.float32)
+            if resampler is not None:
+                speech = resampler.resample_chunk(speech)
+            if previous is None:
+                previous = speech
+            elif len(speech) < min_length:
+                previous = np.concatenate([previous, speech])
+            else:
+                yield previous
+                previous = speech
+        if resampler is not None:
+            speech = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+            previous = speech if previous is None else np.concatenate([previous, speech])
+        if previous is not None and len(previous):
+            yield previous
+
+
+def num_frames(model, length):
+    """
+    The number of frames the model predicts for `length` samples of input.
+    Inputs that give less than one frame cannot go through the feature
+    encoder.
+    """
+    return int(model._get_feat_extract_output_lengths(torch.tensor(length)))
+
+
+def to_device(chunks, device, max_length):
+    """
+    Moves a stream of (1, n) CPU tensors to `device`. On CUDA the chunks are
+    staged through two pinned buffers and copied on a side stream into two
+    preallocated device buffers, so that the preprocessing and copy of the
+    next chunk overlap with the forward pass on the current one without
+    allocating per chunk. The yielded tensor is only valid until the next
+    chunk is requested. None chunks are passed through as is.
+    """
+    if device.type != 'cuda':
+        for chunk in chunks:
+            yield chunk if chunk is None else chunk.to(device)
+        return
+
+    pinned = [torch.empty(1, max_length, dtype=torch.float32, pin_memory=True)
+              for _ in range(2)]
+    buffers = [torch.empty(1, max_length, dtype=torch.float32, device=device)
+               for _ in range(2)]
+    copied = [torch.cuda.Event(), torch.cuda.Event()]
+    released = [torch.cuda.Event(), torch.cuda.Event()]
+    copy_stream = torch.cuda.Stream(device)
+    compute_stream = torch.cuda.current_stream(device)
+
+    for i, chunk in enumerate(chunks):
+        if chunk is None:
+            yield chunk
+            continue
+        n = chunk.shape[-1]
+        if n > max_length:
+            yield chunk.to(device)
+            continue
+        slot = i % 2
+        # The previous copy must have left the pinned buffer before reuse
+        copied[slot].synchronize()
+        pinned[slot][:, :n].copy_(chunk)
+        with torch.cuda.stream(copy_stream):
+            # and the forward pass that read the device buffer must be done
+            copy_stream.wait_event(released[slot])
+            buffers[slot][:, :n].copy_(pinned[slot][:, :n], non_blocking=True)
+            copied[slot].record(copy_stream)
+        compute_stream.wait_stream(copy_stream)
+        yield buffers[slot][:, :n]
+        released[slot].record(compute_stream)
+
+
+def pad_chunk(input_values, length):
+    """
+    Right pads a (1, n) chunk with zeros to `length` samples. Returns the
+    padded chunk along with an attention mask covering the original samples.
+    """
+    n = input_values.shape[-1]
+    attention_mask = torch.zeros(
+        1, max(n, length), dtype=torch.long, device=input_values.device)
+    attention_mask[:, :n] = 1
+    if n >= length:
+        return input_values, attention_mask
+    return torch.nn.functional.pad(input_values, (0, length - n)), attention_mask
+
+
+class CudaGraphForward:
+    """
+    Captures the forward pass and argmax over one fixed size chunk in a CUDA
+    graph, so that transcribing a chunk is a single graph replay instead of
+    hundreds of kernel launches. The static buffers are shared, so calls
+    must not run concurrently. Capturing puts the whole process in capture
+    mode, so no other thread may use the device meanwhile.
+    """
+
+    def __init__(self, model, chunk_length, dtype=None, use_attention_mask=True, pool=None):
+        device = model.device
+        self.static_input = torch.zeros(1, chunk_length, device=device)
+        self.static_mask = torch.ones(
+            1, chunk_length, dtype=torch.long, device=device) if use_attention_mask else None
+
+        # Warm up on a side stream before capturing, as required by CUDA graphs
+        side_stream = torch.cuda.Stream(device)
+        side_stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(side_stream), torch.inference_mode(), \
+                _autocast(device, dtype, cache_enabled=False):
+            for _ in range(3):
+                model(self.static_input, attention_mask=self.static_mask)
+        torch.cuda.current_stream(device).wait_stream(side_stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph, pool=pool), torch.inference_mode(), \
+                _autocast(device, dtype, cache_enabled=False):
+            logits = model(self.static_input, attention_mask=self.static_mask).logits
+            self.static_ids = logits.argmax(dim=-1).int()
+            del logits
+
+    def __call__(self, input_values, attention_mask=None):
+        """
+        input_values: a (1, chunk_length) tensor on the graph's device
+        attention_mask: the matching mask, if the graph was captured with one
 
-    averages = dict()
-    stds = dict()
-    variances = dict()
+        return: the predicted ids for the chunk
+        """
+        self.static_input.copy_(input_values)
+        if self.static_mask is not None:
+            self.static_mask.copy_(attention_mask)
+        self.graph.replay()
+        return self.static_ids.clone()
+
+
+class FixedShapeForward:
+    """
+    Runs the forward pass and argmax over streamed chunks padded up to one of
+    the lengths in `chunk_seconds`, so that a compiled model or a CUDA graph
+    is only ever specialized to those shapes. The graphs for all lengths are
+    captured up front, as capturing while other threads use the device
+    would fail, so this must be created before any transcription starts.
+    """
+
+    def __init__(self, model, dtype=None, use_attention_mask=True, compile=False, cuda_graph=False,
+                 chunk_seconds=CHUNK_SECONDS, sample_rate=16000):
+        self.model = model
+        self.dtype = dtype
+        self.use_attention_mask = use_attention_mask
+        self.cuda_graph = cuda_graph
+        self.lengths = sorted(seconds * sample_rate for seconds in chunk_seconds)
+        self.forward_model = model
+        if compile:
+            # The chunks are captured in CUDA graphs of our own, so only let
+            # torch.compile do so when those are turned off
+            mode = "default" if cuda_graph else "reduce-overhead"
+            self.forward_model = torch.compile(model, mode=mode)
+            logger.info("Compiled model")
+        self.graphs = {}
+        if cuda_graph:
+            # Longest first, so that the shorter graphs fit in the memory
+            # pool of the first one
+            pool = None
+            for length in reversed(self.lengths):
+                self.graphs[length] = CudaGraphForward(
+                    self.forward_model, length, dtype=dtype,
+                    use_attention_mask=use_attention_mask, pool=pool)
+                pool = self.graphs[length].graph.pool()
+                logger.info("Captured CUDA graph for {} samples".format(length))
+        # The compiled model and the graphs are shared between threads, so
+        # chunks are run one at a time
+        self.lock = threading.Lock()
+
+    def __call__(self, input_values):
+        """
+        input_values: a (1, n) chunk on the model's device
 
-    for token, durations in token_durations.items():
-        average = np.sum(durations) / len(durations)
-        std = np.std(durations)
-        # print("the tokens are", token)
-        # print("the durations are", durations)
-        # print("the average is", average)
-        variance = calculate_variance(durations)
-        averages[token] = average
-        stds[token] = std
-        variances[token] = variance
+        return: the predicted ids for the chunk, or None if the chunk does
+            not fit one of the fixed lengths and should be run as is
+        """
+        n = input_values.shape[-1]
+        length = next((length for length in self.lengths if length >= n), None)
+        # Without an attention mask the padding would change the
+        # normalization statistics of the model, so only exact fits are used
+        if length is None or (length != n and not self.use_attention_mask):
+            return None
+        input_values, attention_mask = pad_chunk(input_values, length)
+        if not self.use_attention_mask:
+            attention_mask = None
+
+        with self.lock, torch.inference_mode():
+            if self.cuda_graph:
+                predicted_ids = self.graphs[length](input_values, attention_mask)
+            else:
+                with _autocast(input_values.device, self.dtype):
+                    logits = self.forward_model(
+                        input_values, attention_mask=attention_mask).logits
+                    predicted_ids = logits.argmax(dim=-1).int()
+                    del logits
 
-    return averages, stds, variances
+        return predicted_ids[:, :num_frames(self.model, n)]
 
 
-def transcribe_from_audio_path(audio_path, model=None, processor=None, model_id=None, language='Swedish', check_language=False, reduce_noise=False, classify_emotion=False, output_word_offsets=False):
+def transcribe_from_audio_path(audio_path, model=None, processor=None, model_id=None, language='Swedish', check_language=False, reduce_noise=False, classify_emotion=False, output_word_offsets=False, dtype=None, chunk_forward=None, silence_threshold=SILENCE_THRESHOLD):
     audio_path, converted = ensure_wav(audio_path, reduce_noise=reduce_noise)
 
     sample_rate = 16000
@@ -310,36 +744,49 @@ def transcribe_from_audio_path(audio_path, model=None, processor=None, model_id=
         model_id = get_model(language)
 
     if not (model and processor):
-        device = torch.device(
-            'cuda' if torch.cuda.is_available() else 'cpu')
-        processor = Wav2Vec2Processor.from_pretrained(model_id)
-        model = Wav2Vec2ForCTC.from_pretrained(model_id).to(device)
-    else:
-        device = model.device
-
-    transcript = ""
-    # Ensure that the sample rate is 16k
+        model, processor = _get_w2v2(model_id, _DEVICE)
+    device = model.device
 
     # Stream over 30 seconds chunks rather than load the full file
-    stream = librosa.stream(
-        audio_path,
-        block_length=30,
-        frame_length=sample_rate,
-        hop_length=sample_rate
-    )
-
-    for speech in stream:
-        if len(speech.shape) > 1:
-            speech = speech[:, 0] + speech[:, 1]
-
-        input_values = processor(
-            speech, sampling_rate=sample_rate, return_tensors="pt").input_values.to(device)
-        logits = model(input_values).logits
+    chunk_length = 30 * sample_rate
+    # Chunks without speech are not run through the model, they become None
+    chunks = (None if is_silent(speech, threshold=silence_threshold)
+              else processor(speech, sampling_rate=sample_rate, return_tensors="pt").input_values
+              for speech in stream_speech(audio_path, sample_rate=sample_rate))
+    # A skipped chunk is replaced by a word delimiter, so that CTC neither
+    # merges repeated tokens across the gap nor joins the words around it
+    separator_id = processor.tokenizer.word_delimiter_token_id
+    if separator_id is None:
+        separator_id = processor.tokenizer.pad_token_id
+    separator = torch.tensor([[separator_id]], dtype=torch.int32, device=device)
+
+    # Keep the predictions on the device and decode them all at once, so
+    # the loop never waits for the GPU. Only the int32 ids are kept, the
+    # logits are dropped in whatever precision they were computed in.
+    chunk_ids = []
+    for input_values in to_device(chunks, device, max_length=chunk_length):
+        if input_values is None:
+            chunk_ids.append(separator)
+            continue
+        # Only a file shorter than a single frame ends up here
+        if num_frames(model, input_values.shape[-1]) < 1:
+            continue
+        predicted_ids = None
+        # A compiled model or a CUDA graph only handles a few fixed lengths,
+        # anything else is run through the model at its own length
+        if chunk_forward is not None:
+            predicted_ids = chunk_forward(input_values)
+        if predicted_ids is None:
+            with torch.inference_mode(), _autocast(device, dtype):
+                logits = model(input_values).logits
+                predicted_ids = logits.argmax(dim=-1).int()
+                del logits
+        chunk_ids.append(predicted_ids)
 
-        predicted_ids = torch.argmax(logits, dim=-1)
-        transcription = processor.decode(predicted_ids[0])
-        transcript += transcription.lower()
-        # print(transcription[0])
+    transcript = ""
+    if chunk_ids:
+        predicted_ids = torch.cat(chunk_ids, dim=1)
+        transcript = processor.batch_decode(predicted_ids)[0].lower()
 
     if converted:
         os.remove(audio_path)
@@ -347,32 +794,28 @@ def transcribe_from_audio_path(audio_path, model=None, processor=None, model_id=
     return transcript
 
 
-def transcribe_bytes(bytes, model=None, processor=None, model_id=None, language='Swedish'):
-    speech, sample_rate = sf.load(io.BytesIO(bytes))
+def transcribe_bytes(bytes, model=None, processor=None, model_id=None, language='Swedish', dtype=None):
+    sample_rate = 16000
+    speech = load_speech_bytes(bytes, sample_rate=sample_rate)
 
     if not (model and processor) and not model_id:
         # print("the language is", language)
         model_id = get_model(language)
 
     if not (model and processor):
-        device = torch.device(
-            'cuda' if torch.cuda.is_available() else 'cpu')
-        processor = Wav2Vec2Processor.from_pretrained(model_id)
-        model = Wav2Vec2ForCTC.from_pretrained(model_id).to(device)
-    else:
-        device = model.device
+        model, processor = _get_w2v2(model_id, _DEVICE)
+    device = model.device
 
     transcript = ""
-    # Ensure that the sample rate is 16k
-
-    if len(speech.shape) > 1:
-        speech = speech[:, 0] + speech[:, 1]
+    if num_frames(model, len(speech)) < 1:
+        return transcript
 
     input_values = processor(
         speech, sampling_rate=sample_rate, return_tensors="pt").input_values.to(device)
-    logits = model(input_values).logits
-
-    predicted_ids = torch.argmax(logits, dim=-1)
+    with torch.inference_mode(), _autocast(device, dtype):
+        logits = model(input_values).logits
+        predicted_ids = logits.argmax(dim=-1)
+        del logits
     transcription = processor.decode(predicted_ids[0])
     transcript += transcription.lower()
     # print(transcription[0])
@@ -380,6 +823,106 @@ def transcribe_bytes(bytes, model=None, processor=None, model_id=None, language=
     return transcript
 
 
+def read_speech(file, sample_rate=16000):
+    """
+    Reads a whole audio file, or file-like object, as a mono float32 array
+    sampled at `sample_rate`.
+    """
+    speech, orig_sample_rate = sf.read(file, dtype='float32', always_2d=False)
+    if speech.ndim > 1:
+        speech = speech.mean(axis=1, dtype=np.float32)
+    # Ensure that the sample rate is 16k
+    if orig_sample_rate != sample_rate:
+        speech = soxr.resample(speech, orig_sample_rate, sample_rate)
+    return speech
+
+
+def load_speech(audio_path, sample_rate=16000):
+    audio_path, converted = ensure_wav(audio_path)
+    speech = read_speech(audio_path, sample_rate=sample_rate)
+    if converted:
+        os.remove(audio_path)
+    return speech
+
+
+def load_speech_bytes(bytes, sample_rate=16000):
+    return read_speech(io.BytesIO(bytes), sample_rate=sample_rate)
+
+
+def split_speech(speech, chunk_length, model):
+    """
+    Splits an utterance into chunks of `chunk_length` samples. A last chunk
+    too short for the model to predict a frame from is appended to the chunk
+    before it, or dropped if there is no such chunk.
+    """
+    chunks = [speech[start:start + chunk_length]
+              for start in range(0, len(speech), chunk_length)]
+    if chunks and num_frames(model, len(chunks[-1])) < 1:
+        chunks.pop()
+        if chunks:
+            chunks[-1] = speech[(len(chunks) - 1) * chunk_length:]
+    return chunks
+
+
+def transcribe_speech_batch(speeches, model, processor, sample_rate=16000, dtype=None, max_batch=MAX_BATCH, chunk_seconds=30):
+    """
+    Transcribes a list of utterances in batches. Utterances longer than
+    `chunk_seconds` are split into chunks, and at most `max_batch` chunks are
+    padded to the longest one and run through the model at once, so that
+    long recordings never go through the model in one piece. Models without
+    an attention mask only batch chunks of the same length.
+
+    speeches: list of 1D arrays sampled at `sample_rate`
+
+    return: list of transcriptions, in the same order as `speeches`
+    """
+    device = model.device
+    chunk_length = chunk_seconds * sample_rate
+    chunks = [(i, chunk)
+              for i, speech in enumerate(speeches)
+              for chunk in split_speech(speech, chunk_length, model)]
+
+    # Without an attention mask the padding would change the normalization
+    # and the group norm statistics of the shorter chunks
+    if processor.feature_extractor.return_attention_mask:
+        groups = [list(range(len(chunks)))]
+    else:
+        groups = {}
+        for k, (_, chunk) in enumerate(chunks):
+            groups.setdefault(len(chunk), []).append(k)
+        groups = list(groups.values())
+
+    chunk_ids = [None] * len(chunks)
+    for group in groups:
+        for start in range(0, len(group), max_batch):
+            batch = group[start:start + max_batch]
+            inputs = processor([chunks[k][1] for k in batch], sampling_rate=sample_rate,
+                               padding=True, return_tensors="pt")
+            input_values = inputs.input_values.to(device)
+            attention_mask = inputs.get("attention_mask")
+            if attention_mask is not None:
+                attention_mask = attention_mask.to(device)
+
+            with torch.inference_mode(), _autocast(device, dtype):
+                logits = model(input_values, attention_mask=attention_mask).logits
+                predicted_ids = logits.argmax(dim=-1)
+                del logits
+
+            # Drop the predictions for the padding
+            frames = model._get_feat_extract_output_lengths(
+                torch.tensor([len(chunks[k][1]) for k in batch]))
+            for k, ids, n in zip(batch, predicted_ids, frames.tolist()):
+                chunk_ids[k] = ids[:n]
+
+    # Put the chunks of each utterance back together
+    speech_ids = [[] for _ in speeches]
+    for (i, _), ids in zip(chunks, chunk_ids):
+        speech_ids[i].append(ids)
+
+    return [processor.decode(torch.cat(ids)).lower() if ids else ""
+            for ids in speech_ids]
+
+
 def output_word_offset(pred_ids, processor, output_word_offsets):
     outputs = processor.batch_decode(
         pred_ids, output_word_offsets=output_word_offsets)
@@ -69,14 +69,28 @@ def convert_to_wav(audio_path: str, output_path: str = None):
     return wavpath
 
 
+def is_pcm_mono(audio_path: str, sample_rate: int = 16000):
+    """
+    Check from the header whether an audio file is mono PCM in the given
+    sample rate, in which case it can be read as is.
+    """
+    try:
+        info = sf.info(audio_path)
+    except RuntimeError:
+        return False
+    return info.samplerate == sample_rate and info.channels == 1 \
+        and info.subtype.startswith("PCM")
+
+
 def ensure_wav(audio_path: str, reduce_noise: bool = False):
     """
     Ensure that an audio file is in wav format. If not, convert it.
     Returns the path to the wav file as well as a boolean specifying if
-    the file was converted.
+    the file was converted. Files that are already 16 kHz mono PCM are
+    returned as they are.
     """
     converted = False
-    if not audio_path.endswith(".wav"):
+    if not audio_path.endswith(".wav") and not is_pcm_mono(audio_path):
         try:
             audio_path = convert_to_wav(audio_path)
             converted = True